@@ -7,12 +7,17 @@ Usage:
     python3 test_server.py [port] [root_path]
 
 Default: port=5640, root=/tmp/9ptest
+
+Set P9_DEBUG=1 to trace every message (ignored under python -O).
 """
 
 import os
 import sys
 import struct
 import socket
+import time
+import operator
+import threading
 import stat as st
 
 # Message types
@@ -49,127 +54,246 @@ EISDIR = 21
 EINVAL = 22
 ENOTEMPTY = 39
 
+# Per-message tracing is too slow to leave on under load
+DEBUG = __debug__ and os.environ.get('P9_DEBUG') == '1'
+
+# Limits
+MAX_MSIZE = 8192
+MAXWELEM = 16  # most names in one Twalk
+SENDFILE_MIN = 4096  # smaller reads are cheaper to copy than to sendfile
+STATFS_TTL = 1.0  # seconds a packed Rstatfs stays valid
+
+# Precompiled wire formats
+_HDR = struct.Struct('<IBH')                         # size[4] type[1] tag[2]
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+_QID = struct.Struct('<BIQ')                         # type[1] version[4] path[8]
+_RVERSION = struct.Struct('<IH')                     # msize[4] version[s] length
+_RLOPEN = struct.Struct('<BIQI')                     # qid[13] iounit[4]
+_RSTATFS = struct.Struct('<IIQQQQQQI')
+# Reported when statvfs fails
+_STATFS_FALLBACK = _RSTATFS.pack(0, 4096, 1000000, 500000, 500000, 100000, 50000, 0, 255)
+_RREADDIR_ENTRY = struct.Struct('<BIQQBH')           # qid[13] offset[8] type[1] name[s] length
+_RGETATTR = struct.Struct('<Q BIQ III QQQQQ QQQQQQQQQQ')  # valid qid attrs times
+
+# rdev, blksize, blocks; not every platform's stat_result has them, so
+# decide once here instead of probing on every Tgetattr
+if all(hasattr(os.stat_result, f) for f in ('st_rdev', 'st_blksize', 'st_blocks')):
+    stat_extra = operator.attrgetter('st_rdev', 'st_blksize', 'st_blocks')
+else:
+    def stat_extra(s):
+        return 0, 4096, 0
+
 class Qid:
-    def __init__(self, path, stat_result=None):
-        self.path = path
+    __slots__ = ('type', 'version', 'ino')
+
+    def __init__(self, path, stat_result=None, ino=None):
         if stat_result:
-            self.type = QTDIR if st.S_ISDIR(stat_result.st_mode) else \
-                        QTSYMLINK if st.S_ISLNK(stat_result.st_mode) else QTFILE
-            self.version = int(stat_result.st_mtime) & 0xFFFFFFFF
+            self.type = qid_type(stat_result.st_mode)
+            self.version = stat_result[st.ST_MTIME] & 0xFFFFFFFF
         else:
             self.type = QTDIR
             self.version = 0
-        self.ino = hash(path) & 0xFFFFFFFFFFFFFFFF
+        self.ino = qid_ino(path) if ino is None else ino
 
-    def pack(self):
-        return struct.pack('<BIQ', self.type, self.version, self.ino)
+def read_string(data, offset, _unpack_len=_U16.unpack_from):
+    slen, = _unpack_len(data, offset)
+    offset += 2
+    return str(data[offset:offset+slen], 'utf-8'), offset + slen
+
+def qid_type(mode):
+    return QTDIR if st.S_ISDIR(mode) else QTSYMLINK if st.S_ISLNK(mode) else QTFILE
+
+def qid_ino(path):
+    return hash(path) & 0xFFFFFFFFFFFFFFFF
+
+class FidEntry:
+    __slots__ = ('path', 'ino', 'fd')
+
+    def __init__(self, path, ino=None, fd=None):
+        self.path = path
+        self.ino = qid_ino(path) if ino is None else ino
+        self.fd = fd
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
 
 class P9Server:
     def __init__(self, root_path):
-        self.root = os.path.abspath(root_path)
-        self.fids = {}  # fid -> path
-        self.msize = 8192
+        # Paths stay bytes so names go to and from the wire without decoding
+        self.root = os.fsencode(os.path.abspath(root_path))
+        self.fids = {}  # fid -> FidEntry
+        self.msize = MAX_MSIZE
+        self.pending_sendfile = None  # (fd, offset, count) to follow a reply
+        self.statfs_cache = {}  # path -> (timestamp, packed Rstatfs payload)
+
+        # Message types are below 128, so dispatch is a plain list lookup
+        self.handlers = [None] * 128
+        self.handlers[P9_TVERSION] = self.handle_version
+        self.handlers[P9_TATTACH] = self.handle_attach
+        self.handlers[P9_TWALK] = self.handle_walk
+        self.handlers[P9_TGETATTR] = self.handle_getattr
+        self.handlers[P9_TSTATFS] = self.handle_statfs
+        self.handlers[P9_TLOPEN] = self.handle_lopen
+        self.handlers[P9_TREADDIR] = self.handle_readdir
+        self.handlers[P9_TREAD] = self.handle_read
+        self.handlers[P9_TCLUNK] = self.handle_clunk
 
     def handle_client(self, conn):
         print(f"Client connected")
+        buf = bytearray(self.msize)
+        mv = memoryview(buf)
+        filled = 0
+        # Replies are packed in place; room for several before a flush
+        out = bytearray(4 * MAX_MSIZE)
+        omv = memoryview(out)
         try:
             while True:
-                # Read message header
-                header = conn.recv(4)
-                if not header:
+                n = conn.recv_into(mv[filled:])
+                if not n:
                     break
-                size = struct.unpack('<I', header)[0]
-                data = header + conn.recv(size - 4)
-
-                # Parse and handle message
-                response = self.handle_message(data)
-                if response:
-                    conn.send(response)
+                filled += n
+
+                # Handle every complete message received so far and answer
+                # the whole batch with a single send
+                pos = 0
+                opos = 0
+                while filled - pos >= 4:
+                    size, = _U32.unpack_from(buf, pos)
+                    if size < 7 or size > len(buf):
+                        # Shorter than a header, or beyond msize
+                        raise ValueError(f"bad message size {size}")
+                    if filled - pos < size:
+                        break
+                    if len(out) - opos < MAX_MSIZE:
+                        conn.sendall(omv[:opos])
+                        opos = 0
+
+                    # Parse and handle message
+                    opos += self.handle_message(mv[pos:pos + size], omv[opos:])
+                    pos += size
+
+                    # Rread data from sendfile must follow its header
+                    if self.pending_sendfile:
+                        conn.sendall(omv[:opos])
+                        opos = 0
+                        self.sendfile(conn, *self.pending_sendfile)
+                        self.pending_sendfile = None
+
+                if opos:
+                    conn.sendall(omv[:opos])
+
+                # Move the trailing partial message to the front
+                if pos:
+                    buf[:filled - pos] = buf[pos:filled]
+                    filled -= pos
         except Exception as e:
             print(f"Error: {e}")
         finally:
+            for fe in self.fids.values():
+                fe.close()
+            self.fids.clear()
             print("Client disconnected")
 
-    def handle_message(self, data):
-        size, mtype, tag = struct.unpack('<IBH', data[:7])
+    def handle_message(self, data, out):
+        size, mtype, tag = _HDR.unpack_from(data, 0)
         payload = data[7:]
-        print(f"  <- T{mtype} tag={tag} size={size}")
-
-        handlers = {
-            P9_TVERSION: self.handle_version,
-            P9_TATTACH: self.handle_attach,
-            P9_TWALK: self.handle_walk,
-            P9_TGETATTR: self.handle_getattr,
-            P9_TSTATFS: self.handle_statfs,
-            P9_TLOPEN: self.handle_lopen,
-            P9_TREADDIR: self.handle_readdir,
-            P9_TREAD: self.handle_read,
-            P9_TCLUNK: self.handle_clunk,
-        }
-
-        handler = handlers.get(mtype)
+        if DEBUG:
+            print(f"  <- T{mtype} tag={tag} size={size}")
+
+        handler = self.handlers[mtype] if mtype < 128 else None
         if handler:
-            return handler(tag, payload)
+            return handler(tag, payload, out)
         else:
-            print(f"  Unhandled message type: {mtype}")
-            return self.error(tag, EINVAL)
-
-    def pack_response(self, mtype, tag, payload):
-        size = 7 + len(payload)
-        return struct.pack('<IBH', size, mtype, tag) + payload
-
-    def error(self, tag, errno):
-        print(f"  -> Rlerror errno={errno}")
-        return self.pack_response(P9_RLERROR, tag, struct.pack('<I', errno))
-
-    def read_string(self, data, offset):
-        slen = struct.unpack_from('<H', data, offset)[0]
-        s = data[offset+2:offset+2+slen].decode('utf-8')
-        return s, offset + 2 + slen
-
-    def pack_string(self, s):
-        encoded = s.encode('utf-8')
-        return struct.pack('<H', len(encoded)) + encoded
-
-    def handle_version(self, tag, payload):
+            if DEBUG:
+                print(f"  Unhandled message type: {mtype}")
+            return self.error(out, tag, EINVAL)
+
+    def sendfile(self, conn, fd, offset, count):
+        sock_fd = conn.fileno()
+        while count:
+            sent = os.sendfile(sock_fd, fd, offset, count)
+            if not sent:
+                # The reply header already promised count bytes
+                raise OSError("file shrank during sendfile")
+            offset += sent
+            count -= sent
+
+    def set_fid(self, fid, fe):
+        # Rebinding a fid must not leak the fd of the entry it replaces
+        old = self.fids.get(fid)
+        if old is not None:
+            old.close()
+        self.fids[fid] = fe
+
+    def pack_response_into(self, out, mtype, tag, payload_len):
+        # The handler has already packed its payload at out[7:]
+        size = 7 + payload_len
+        _HDR.pack_into(out, 0, size, mtype, tag)
+        return size
+
+    def error(self, out, tag, errno):
+        if DEBUG:
+            print(f"  -> Rlerror errno={errno}")
+        _U32.pack_into(out, 7, errno)
+        return self.pack_response_into(out, P9_RLERROR, tag, 4)
+
+    def handle_version(self, tag, payload, out):
         msize, = struct.unpack_from('<I', payload, 0)
-        version, _ = self.read_string(payload, 4)
-        print(f"  Tversion msize={msize} version={version}")
+        version, _ = read_string(payload, 4)
+        if DEBUG:
+            print(f"  Tversion msize={msize} version={version}")
 
         # Negotiate
-        self.msize = min(msize, 8192)
+        self.msize = min(msize, MAX_MSIZE)
         resp_version = "9P2000.L" if "9P2000.L" in version else "unknown"
 
-        resp = struct.pack('<I', self.msize) + self.pack_string(resp_version)
-        print(f"  -> Rversion msize={self.msize} version={resp_version}")
-        return self.pack_response(P9_RVERSION, tag, resp)
+        encoded = resp_version.encode('utf-8')
+        _RVERSION.pack_into(out, 7, self.msize, len(encoded))
+        end = 7 + _RVERSION.size + len(encoded)
+        out[7 + _RVERSION.size:end] = encoded
+        if DEBUG:
+            print(f"  -> Rversion msize={self.msize} version={resp_version}")
+        return self.pack_response_into(out, P9_RVERSION, tag, end - 7)
 
-    def handle_attach(self, tag, payload):
+    def handle_attach(self, tag, payload, out):
         fid, afid = struct.unpack_from('<II', payload, 0)
-        uname, offset = self.read_string(payload, 8)
-        aname, offset = self.read_string(payload, offset)
-        print(f"  Tattach fid={fid} afid={afid} uname={uname} aname={aname}")
+        uname, offset = read_string(payload, 8)
+        aname, offset = read_string(payload, offset)
+        if DEBUG:
+            print(f"  Tattach fid={fid} afid={afid} uname={uname} aname={aname}")
 
         # Attach to root
-        self.fids[fid] = self.root
-        qid = Qid(self.root, os.stat(self.root))
+        fe = FidEntry(self.root)
+        self.set_fid(fid, fe)
+        qid = Qid(fe.path, os.stat(fe.path), fe.ino)
 
-        print(f"  -> Rattach qid.type=0x{qid.type:02x}")
-        return self.pack_response(P9_RATTACH, tag, qid.pack())
+        _QID.pack_into(out, 7, qid.type, qid.version, qid.ino)
+        if DEBUG:
+            print(f"  -> Rattach qid.type=0x{qid.type:02x}")
+        return self.pack_response_into(out, P9_RATTACH, tag, _QID.size)
 
-    def handle_walk(self, tag, payload):
+    def handle_walk(self, tag, payload, out):
         fid, newfid, nwname = struct.unpack_from('<IIH', payload, 0)
+        if nwname > MAXWELEM:
+            return self.error(out, tag, EINVAL)
         offset = 10
         names = []
+        unpack_len = _U16.unpack_from
         for _ in range(nwname):
-            name, offset = self.read_string(payload, offset)
-            names.append(name)
-        print(f"  Twalk fid={fid} newfid={newfid} nwname={nwname} names={names}")
+            slen, = unpack_len(payload, offset)
+            offset += 2 + slen
+            names.append(bytes(payload[offset-slen:offset]))
+        if DEBUG:
+            print(f"  Twalk fid={fid} newfid={newfid} nwname={nwname} names={names}")
 
         if fid not in self.fids:
-            return self.error(tag, ENOENT)
+            return self.error(out, tag, ENOENT)
 
-        path = self.fids[fid]
+        fe = self.fids[fid]
+        path = fe.path
         qids = []
 
         for name in names:
@@ -178,155 +302,224 @@ class P9Server:
                 break
             qids.append(Qid(path, os.stat(path)))
 
-        if len(qids) == nwname or nwname == 0:
-            self.fids[newfid] = path
+        if nwname == 0:
+            self.set_fid(newfid, FidEntry(path, fe.ino))
+        elif len(qids) == nwname:
+            self.set_fid(newfid, FidEntry(path, qids[-1].ino))
 
-        resp = struct.pack('<H', len(qids))
+        # nwqid[2] then each qid[13], packed in place
+        _U16.pack_into(out, 7, len(qids))
+        off = 9
         for qid in qids:
-            resp += qid.pack()
+            _QID.pack_into(out, off, qid.type, qid.version, qid.ino)
+            off += _QID.size
 
-        print(f"  -> Rwalk nwqid={len(qids)}")
-        return self.pack_response(P9_RWALK, tag, resp)
+        if DEBUG:
+            print(f"  -> Rwalk nwqid={len(qids)}")
+        return self.pack_response_into(out, P9_RWALK, tag, off - 7)
 
-    def handle_getattr(self, tag, payload):
+    def handle_getattr(self, tag, payload, out):
         fid, mask = struct.unpack_from('<IQ', payload, 0)
-        print(f"  Tgetattr fid={fid} mask=0x{mask:x}")
+        if DEBUG:
+            print(f"  Tgetattr fid={fid} mask=0x{mask:x}")
 
         if fid not in self.fids:
-            return self.error(tag, ENOENT)
-
-        path = self.fids[fid]
-        s = os.stat(path)
-        qid = Qid(path, s)
-
-        resp = struct.pack('<Q', mask)  # valid
-        resp += qid.pack()
-        resp += struct.pack('<IIIQQQQQ',
-            s.st_mode, s.st_uid, s.st_gid,
-            s.st_nlink, s.st_rdev if hasattr(s, 'st_rdev') else 0,
-            s.st_size, s.st_blksize if hasattr(s, 'st_blksize') else 4096,
-            s.st_blocks if hasattr(s, 'st_blocks') else 0)
-        # Times
-        resp += struct.pack('<QQQQQQQQQQ',
-            int(s.st_atime), 0,  # atime_sec, atime_nsec
-            int(s.st_mtime), 0,  # mtime_sec, mtime_nsec
-            int(s.st_ctime), 0,  # ctime_sec, ctime_nsec
+            return self.error(out, tag, ENOENT)
+
+        fe = self.fids[fid]
+        s = os.stat(fe.path)
+        # One unpack of the stat tuple (integer times) instead of a lookup per field
+        mode, _, _, nlink, uid, gid, size, atime, mtime, ctime = s
+        rdev, blksize, blocks = stat_extra(s)
+
+        _RGETATTR.pack_into(out, 7,
+            mask,  # valid
+            qid_type(mode), mtime & 0xFFFFFFFF, fe.ino,  # qid
+            mode, uid, gid,
+            nlink, rdev, size, blksize, blocks,
+            atime, 0,  # atime_sec, atime_nsec
+            mtime, 0,  # mtime_sec, mtime_nsec
+            ctime, 0,  # ctime_sec, ctime_nsec
             0, 0,  # btime_sec, btime_nsec
             0, 0)  # gen, data_version
 
-        print(f"  -> Rgetattr mode=0o{s.st_mode:o} size={s.st_size}")
-        return self.pack_response(P9_RGETATTR, tag, resp)
+        if DEBUG:
+            print(f"  -> Rgetattr mode=0o{mode:o} size={size}")
+        return self.pack_response_into(out, P9_RGETATTR, tag, _RGETATTR.size)
 
-    def handle_statfs(self, tag, payload):
+    def handle_statfs(self, tag, payload, out):
         fid, = struct.unpack_from('<I', payload, 0)
-        print(f"  Tstatfs fid={fid}")
+        if DEBUG:
+            print(f"  Tstatfs fid={fid}")
 
         if fid not in self.fids:
-            return self.error(tag, ENOENT)
-
-        path = self.fids[fid]
-        try:
-            s = os.statvfs(path)
-            resp = struct.pack('<IIQQQQQQI',
-                0,  # type
-                s.f_bsize,  # bsize
-                s.f_blocks,  # blocks
-                s.f_bfree,  # bfree
-                s.f_bavail,  # bavail
-                s.f_files,  # files
-                s.f_ffree,  # ffree
-                0,  # fsid
-                s.f_namemax)  # namelen
-        except:
-            resp = struct.pack('<IIQQQQQQI', 0, 4096, 1000000, 500000, 500000, 100000, 50000, 0, 255)
-
-        print(f"  -> Rstatfs")
-        return self.pack_response(P9_RSTATFS, tag, resp)
-
-    def handle_lopen(self, tag, payload):
+            return self.error(out, tag, ENOENT)
+
+        # Free space moves slowly; clients polling statfs reuse the last answer
+        path = self.fids[fid].path
+        now = time.monotonic()
+        cached = self.statfs_cache.get(path)
+        if cached and now - cached[0] < STATFS_TTL:
+            resp = cached[1]
+        else:
+            try:
+                s = os.statvfs(path)
+                resp = _RSTATFS.pack(
+                    0,  # type
+                    s.f_bsize,  # bsize
+                    s.f_blocks,  # blocks
+                    s.f_bfree,  # bfree
+                    s.f_bavail,  # bavail
+                    s.f_files,  # files
+                    s.f_ffree,  # ffree
+                    0,  # fsid
+                    s.f_namemax)  # namelen
+            except:
+                resp = _STATFS_FALLBACK
+            # Drop expired entries so the cache only holds recent paths
+            self.statfs_cache = {p: e for p, e in self.statfs_cache.items()
+                                 if now - e[0] < STATFS_TTL}
+            self.statfs_cache[path] = (now, resp)
+        out[7:7 + _RSTATFS.size] = resp
+
+        if DEBUG:
+            print(f"  -> Rstatfs")
+        return self.pack_response_into(out, P9_RSTATFS, tag, _RSTATFS.size)
+
+    def handle_lopen(self, tag, payload, out):
         fid, flags = struct.unpack_from('<II', payload, 0)
-        print(f"  Tlopen fid={fid} flags=0x{flags:x}")
+        if DEBUG:
+            print(f"  Tlopen fid={fid} flags=0x{flags:x}")
 
         if fid not in self.fids:
-            return self.error(tag, ENOENT)
-
-        path = self.fids[fid]
-        s = os.stat(path)
-        qid = Qid(path, s)
+            return self.error(out, tag, ENOENT)
+
+        fe = self.fids[fid]
+        s = os.stat(fe.path)
+        mode = s.st_mode
+
+        # Keep regular files open so Tread can pread without reopening
+        fe.close()
+        if st.S_ISREG(mode):
+            try:
+                fe.fd = os.open(fe.path, os.O_RDONLY)
+            except OSError as e:
+                print(f"  open error: {e}")
+                return self.error(out, tag, e.errno)
+            # Clients mostly stream files front to back; widen readahead
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fe.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
 
         iounit = self.msize - 24
-        resp = qid.pack() + struct.pack('<I', iounit)
+        _RLOPEN.pack_into(out, 7,
+            qid_type(mode), s[st.ST_MTIME] & 0xFFFFFFFF, fe.ino, iounit)
 
-        print(f"  -> Rlopen iounit={iounit}")
-        return self.pack_response(P9_RLOPEN, tag, resp)
+        if DEBUG:
+            print(f"  -> Rlopen iounit={iounit}")
+        return self.pack_response_into(out, P9_RLOPEN, tag, _RLOPEN.size)
 
-    def handle_readdir(self, tag, payload):
+    def handle_readdir(self, tag, payload, out):
         fid, offset, count = struct.unpack_from('<IQI', payload, 0)
-        print(f"  Treaddir fid={fid} offset={offset} count={count}")
+        if DEBUG:
+            print(f"  Treaddir fid={fid} offset={offset} count={count}")
 
         if fid not in self.fids:
-            return self.error(tag, ENOENT)
+            return self.error(out, tag, ENOENT)
 
-        path = self.fids[fid]
+        path = self.fids[fid].path
         if not os.path.isdir(path):
-            return self.error(tag, ENOTDIR)
-
-        entries = []
+            return self.error(out, tag, ENOTDIR)
+
+        # Entries are written straight into the response after the
+        # header and count[4]; the whole reply must still fit in msize.
+        count = min(count, self.msize - 7)
+        off = 11
+        end = 7 + count
+        nentries = 0
         try:
-            for i, name in enumerate(os.listdir(path)):
-                if i < offset:
-                    continue
-                entry_path = os.path.join(path, name)
-                s = os.stat(entry_path)
-                qid = Qid(entry_path, s)
-
-                # Pack entry: qid[13] offset[8] type[1] name[s]
-                entry = qid.pack()
-                entry += struct.pack('<QB', i + 1, qid.type)
-                entry += self.pack_string(name)
-                entries.append(entry)
-
-                if sum(len(e) for e in entries) > count - 4:
-                    entries.pop()
-                    break
+            with os.scandir(path) as it:
+                for i, entry in enumerate(it):
+                    if i < offset:
+                        continue
+                    name = entry.name
+                    entry_end = off + _RREADDIR_ENTRY.size + len(name)
+                    if entry_end > end:
+                        break
+
+                    # The qid version needs st_mtime, so one lstat per
+                    # entry remains; DirEntry skips the path join.
+                    s = entry.stat(follow_symlinks=False)
+                    qtype = qid_type(s.st_mode)
+
+                    # Pack entry: qid[13] offset[8] type[1] name[s]
+                    _RREADDIR_ENTRY.pack_into(out, off,
+                        qtype, s[st.ST_MTIME] & 0xFFFFFFFF, qid_ino(entry.path),
+                        i + 1, qtype, len(name))
+                    out[entry_end - len(name):entry_end] = name
+                    off = entry_end
+                    nentries += 1
         except Exception as e:
             print(f"  readdir error: {e}")
 
-        data = b''.join(entries)
-        resp = struct.pack('<I', len(data)) + data
+        _U32.pack_into(out, 7, off - 11)
 
-        print(f"  -> Rreaddir count={len(data)} entries={len(entries)}")
-        return self.pack_response(P9_RREADDIR, tag, resp)
+        if DEBUG:
+            print(f"  -> Rreaddir count={off - 11} entries={nentries}")
+        return self.pack_response_into(out, P9_RREADDIR, tag, off - 7)
 
-    def handle_read(self, tag, payload):
+    def handle_read(self, tag, payload, out):
         fid, offset, count = struct.unpack_from('<IQI', payload, 0)
-        print(f"  Tread fid={fid} offset={offset} count={count}")
+        if DEBUG:
+            print(f"  Tread fid={fid} offset={offset} count={count}")
 
         if fid not in self.fids:
-            return self.error(tag, ENOENT)
+            return self.error(out, tag, ENOENT)
+
+        fe = self.fids[fid]
+        if fe.fd is None:
+            # Not opened by Tlopen, or a directory
+            return self.error(out, tag, EINVAL)
+        if offset >= 1 << 63:
+            # Past what off_t can hold; pread would raise OverflowError
+            return self.error(out, tag, EINVAL)
 
-        path = self.fids[fid]
+        count = min(count, self.msize - 11)
         try:
-            with open(path, 'rb') as f:
-                f.seek(offset)
-                data = f.read(count)
-        except Exception as e:
+            if count >= SENDFILE_MIN and hasattr(os, 'sendfile'):
+                # The header needs the exact length up front, and sendfile
+                # only pays off if that many bytes are really there
+                count = min(count, max(0, os.fstat(fe.fd).st_size - offset))
+                if count >= SENDFILE_MIN:
+                    # Let the kernel copy the data right after the header
+                    self.pending_sendfile = (fe.fd, offset, count)
+            if self.pending_sendfile:
+                n = count
+            else:
+                # Read the file data straight into the reply after count[4]
+                n = os.preadv(fe.fd, [out[11:11 + count]], offset)
+        except OSError as e:
             print(f"  read error: {e}")
-            return self.error(tag, EINVAL)
+            return self.error(out, tag, EINVAL)
 
-        resp = struct.pack('<I', len(data)) + data
-        print(f"  -> Rread count={len(data)}")
-        return self.pack_response(P9_RREAD, tag, resp)
+        _U32.pack_into(out, 7, n)
+        if DEBUG:
+            print(f"  -> Rread count={n}")
+        # A pending sendfile supplies the data, so size covers it too
+        self.pack_response_into(out, P9_RREAD, tag, 4 + n)
+        return 11 if self.pending_sendfile else 11 + n
 
-    def handle_clunk(self, tag, payload):
+    def handle_clunk(self, tag, payload, out):
         fid, = struct.unpack_from('<I', payload, 0)
-        print(f"  Tclunk fid={fid}")
+        if DEBUG:
+            print(f"  Tclunk fid={fid}")
 
-        if fid in self.fids:
-            del self.fids[fid]
+        fe = self.fids.pop(fid, None)
+        if fe is not None:
+            fe.close()
 
-        print(f"  -> Rclunk")
-        return self.pack_response(P9_RCLUNK, tag, b'')
+        if DEBUG:
+            print(f"  -> Rclunk")
+        return self.pack_response_into(out, P9_RCLUNK, tag, 0)
 
 def main():
     port = int(sys.argv[1]) if len(sys.argv) > 1 else 5640
@@ -339,12 +532,19 @@ def main():
         with open(test_file, 'w') as f:
             f.write('Hello World\n')
 
-    server = P9Server(root)
+    def serve(conn):
+        # fids and msize are per session, so each client gets its own server
+        try:
+            # Replies are small; do not let Nagle hold them back
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            P9Server(root).handle_client(conn)
+        finally:
+            conn.close()
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     sock.bind(('0.0.0.0', port))
-    sock.listen(1)
+    sock.listen()
 
     print(f"9P2000.L test server listening on port {port}")
     print(f"Serving directory: {root}")
@@ -353,8 +553,7 @@ def main():
     try:
         while True:
             conn, addr = sock.accept()
-            server.handle_client(conn)
-            conn.close()
+            threading.Thread(target=serve, args=(conn,), daemon=True).start()
     except KeyboardInterrupt:
         print("\nShutting down")
     finally: